@@ -635,8 +635,11 @@ class ClusteredConversationManager(StandaloneConversationManager):
                     to_delete.append(key)
 
             logger.info(f'removing connections: {connection_ids_to_remove}')
+            await wait_all(
+                self.sio.disconnect(connection_id)
+                for connection_id in connection_ids_to_remove
+            )
             for connection_id in connection_ids_to_remove:
-                await self.sio.disconnect(connection_id)
                 self._local_connection_id_to_session_id.pop(connection_id, None)
 
         # Delete the conversation key if running locally
@@ -8,6 +8,7 @@
 # This module belongs to the old V0 web server. The V1 application server lives under openhands/app_server/.
 import asyncio
 import os
+import re
 import time
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
@@ -58,6 +59,11 @@ from openhands.utils.utils import create_registry_and_conversation_stats
 from .conversation_manager import ConversationManager
 
 _CLEANUP_INTERVAL = 15
+# Git commands that can change the checked out branch. Matched anywhere in the
+# command so compound commands like "cd workspace && git checkout x" count.
+_GIT_BRANCH_COMMAND_RE = re.compile(
+    r'git (?:checkout|switch|merge|rebase|reset|branch)', re.IGNORECASE | re.ASCII
+)
 UPDATED_AT_CALLBACK_ID = 'updated_at_callback_id'
 
 
@@ -582,8 +588,11 @@ class StandaloneConversationManager(ConversationManager):
             extra={'session_id': sid},
         )
         # Perform a graceful shutdown of each connection
+        await wait_all(
+            self.sio.disconnect(connection_id)
+            for connection_id in connection_ids_to_remove
+        )
         for connection_id in connection_ids_to_remove:
-            await self.sio.disconnect(connection_id)
             self._local_connection_id_to_session_id.pop(connection_id, None)
 
         session = self._local_agent_loops_by_sid.pop(sid, None)
@@ -724,20 +733,8 @@ class StandaloneConversationManager(ConversationManager):
             event.observation == ObservationType.RUN
             and event.metadata.exit_code == 0  # Only consider successful commands
         ):
-            command = event.command.lower()
-
-            # Check if any git command that changes branches is present anywhere in the command
-            # This handles compound commands like "cd workspace && git checkout feature-branch"
-            git_commands = [
-                'git checkout',
-                'git switch',
-                'git merge',
-                'git rebase',
-                'git reset',
-                'git branch',
-            ]
-
-            is_git_related = any(git_cmd in command for git_cmd in git_commands)
+            command = event.command
+            is_git_related = _GIT_BRANCH_COMMAND_RE.search(command) is not None
 
             if is_git_related:
                 logger.debug(
@@ -819,8 +816,9 @@ class StandaloneConversationManager(ConversationManager):
 
         return runtime.get_workspace_branch(primary_repo_path)
 
+    @staticmethod
     def _should_update_branch(
-        self, current_branch: str | None, new_branch: str | None
+        current_branch: str | None, new_branch: str | None
     ) -> bool:
         """
         Determine if the branch should be updated.
@@ -834,8 +832,9 @@ class StandaloneConversationManager(ConversationManager):
         """
         return new_branch is not None and new_branch != current_branch
 
+    @staticmethod
     def _update_branch_in_conversation(
-        self, conversation: ConversationMetadata, new_branch: str | None
+        conversation: ConversationMetadata, new_branch: str | None
     ):
         """
         Update the branch in the conversation metadata.
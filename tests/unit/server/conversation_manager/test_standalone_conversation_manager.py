@@ -6,6 +6,10 @@ from unittest.mock import AsyncMock, MagicMock, patch
 import pytest
 
 from openhands.core.config.openhands_config import OpenHandsConfig
+from openhands.events.observation.commands import (
+    CmdOutputMetadata,
+    CmdOutputObservation,
+)
 from openhands.server.conversation_manager.standalone_conversation_manager import (
     StandaloneConversationManager,
 )
@@ -35,136 +39,100 @@ def get_mock_sio(get_message: GetMessageMock | None = None):
     return sio
 
 
-@pytest.mark.asyncio
-async def test_init_new_local_session():
+@pytest.fixture
+def session_instance():
+    """The Session the manager creates, with no agent loops running elsewhere."""
     session_instance = AsyncMock()
     session_instance.agent_session = MagicMock()
     session_instance.agent_session.event_stream.cur_id = 1
-    mock_session = MagicMock()
-    mock_session.return_value = session_instance
-    sio = get_mock_sio()
-    get_running_agent_loops_mock = AsyncMock()
-    get_running_agent_loops_mock.return_value = set()
-    is_agent_loop_running_mock = AsyncMock()
-    is_agent_loop_running_mock.return_value = True
     with (
         patch(
             'openhands.server.conversation_manager.standalone_conversation_manager.Session',
-            mock_session,
+            MagicMock(return_value=session_instance),
         ),
         patch(
             'openhands.server.conversation_manager.standalone_conversation_manager.StandaloneConversationManager.get_running_agent_loops',
-            get_running_agent_loops_mock,
+            AsyncMock(return_value=set()),
         ),
     ):
-        async with StandaloneConversationManager(
-            sio, OpenHandsConfig(), InMemoryFileStore(), MonitoringListener()
-        ) as conversation_manager:
-            await conversation_manager.maybe_start_agent_loop(
-                'new-session-id', ConversationInitData(), 1
+        yield session_instance
+
+
+async def test_init_new_local_session(session_instance):
+    sio = get_mock_sio()
+    is_agent_loop_running_mock = AsyncMock()
+    is_agent_loop_running_mock.return_value = True
+    async with StandaloneConversationManager(
+        sio, OpenHandsConfig(), InMemoryFileStore(), MonitoringListener()
+    ) as conversation_manager:
+        await conversation_manager.maybe_start_agent_loop(
+            'new-session-id', ConversationInitData(), 1
+        )
+        with (
+            patch(
+                'openhands.server.conversation_manager.standalone_conversation_manager.StandaloneConversationManager.is_agent_loop_running',
+                is_agent_loop_running_mock,
+            ),
+        ):
+            await conversation_manager.join_conversation(
+                'new-session-id',
+                'new-session-id',
+                ConversationInitData(),
+                1,
             )
-            with (
-                patch(
-                    'openhands.server.conversation_manager.standalone_conversation_manager.StandaloneConversationManager.is_agent_loop_running',
-                    is_agent_loop_running_mock,
-                ),
-            ):
-                await conversation_manager.join_conversation(
-                    'new-session-id',
-                    'new-session-id',
-                    ConversationInitData(),
-                    1,
-                )
     assert session_instance.initialize_agent.call_count == 1
     assert sio.enter_room.await_count == 1
 
 
-@pytest.mark.asyncio
-async def test_join_local_session():
-    session_instance = AsyncMock()
-    session_instance.agent_session = MagicMock()
-    mock_session = MagicMock()
-    mock_session.return_value = session_instance
-    session_instance.agent_session.event_stream.cur_id = 1
+async def test_join_local_session(session_instance):
     sio = get_mock_sio()
-    get_running_agent_loops_mock = AsyncMock()
-    get_running_agent_loops_mock.return_value = set()
     is_agent_loop_running_mock = AsyncMock()
     is_agent_loop_running_mock.return_value = True
-    with (
-        patch(
-            'openhands.server.conversation_manager.standalone_conversation_manager.Session',
-            mock_session,
-        ),
-        patch(
-            'openhands.server.conversation_manager.standalone_conversation_manager.StandaloneConversationManager.get_running_agent_loops',
-            get_running_agent_loops_mock,
-        ),
-    ):
-        async with StandaloneConversationManager(
-            sio, OpenHandsConfig(), InMemoryFileStore(), MonitoringListener()
-        ) as conversation_manager:
-            await conversation_manager.maybe_start_agent_loop(
-                'new-session-id', ConversationInitData(), None
+    async with StandaloneConversationManager(
+        sio, OpenHandsConfig(), InMemoryFileStore(), MonitoringListener()
+    ) as conversation_manager:
+        await conversation_manager.maybe_start_agent_loop(
+            'new-session-id', ConversationInitData(), None
+        )
+        with (
+            patch(
+                'openhands.server.conversation_manager.standalone_conversation_manager.StandaloneConversationManager.is_agent_loop_running',
+                is_agent_loop_running_mock,
+            ),
+        ):
+            await conversation_manager.join_conversation(
+                'new-session-id',
+                'new-session-id',
+                ConversationInitData(),
+                None,
+            )
+            await conversation_manager.join_conversation(
+                'new-session-id',
+                'new-session-id',
+                ConversationInitData(),
+                None,
             )
-            with (
-                patch(
-                    'openhands.server.conversation_manager.standalone_conversation_manager.StandaloneConversationManager.is_agent_loop_running',
-                    is_agent_loop_running_mock,
-                ),
-            ):
-                await conversation_manager.join_conversation(
-                    'new-session-id',
-                    'new-session-id',
-                    ConversationInitData(),
-                    None,
-                )
-                await conversation_manager.join_conversation(
-                    'new-session-id',
-                    'new-session-id',
-                    ConversationInitData(),
-                    None,
-                )
     assert session_instance.initialize_agent.call_count == 1
     assert sio.enter_room.await_count == 2
 
 
-@pytest.mark.asyncio
-async def test_add_to_local_event_stream():
-    session_instance = AsyncMock()
-    session_instance.agent_session = MagicMock()
-    mock_session = MagicMock()
-    mock_session.return_value = session_instance
-    session_instance.agent_session.event_stream.cur_id = 1
+async def test_add_to_local_event_stream(session_instance):
     sio = get_mock_sio()
-    get_running_agent_loops_mock = AsyncMock()
-    get_running_agent_loops_mock.return_value = set()
-    with (
-        patch(
-            'openhands.server.conversation_manager.standalone_conversation_manager.Session',
-            mock_session,
-        ),
-        patch(
-            'openhands.server.conversation_manager.standalone_conversation_manager.StandaloneConversationManager.get_running_agent_loops',
-            get_running_agent_loops_mock,
-        ),
-    ):
-        async with StandaloneConversationManager(
-            sio, OpenHandsConfig(), InMemoryFileStore(), MonitoringListener()
-        ) as conversation_manager:
-            await conversation_manager.maybe_start_agent_loop(
-                'new-session-id', ConversationInitData(), 1
-            )
-            await conversation_manager.join_conversation(
-                'new-session-id', 'connection-id', ConversationInitData(), 1
-            )
-            await conversation_manager.send_to_event_stream(
-                'connection-id', {'event_type': 'some_event'}
-            )
+    async with StandaloneConversationManager(
+        sio, OpenHandsConfig(), InMemoryFileStore(), MonitoringListener()
+    ) as conversation_manager:
+        await conversation_manager.maybe_start_agent_loop(
+            'new-session-id', ConversationInitData(), 1
+        )
+        await conversation_manager.join_conversation(
+            'new-session-id', 'connection-id', ConversationInitData(), 1
+        )
+        await conversation_manager.send_to_event_stream(
+            'connection-id', {'event_type': 'some_event'}
+        )
     session_instance.dispatch.assert_called_once_with({'event_type': 'some_event'})
 
 
-@pytest.mark.asyncio
 async def test_cleanup_session_connections():
     sio = get_mock_sio()
     sio.disconnect = AsyncMock()  # Mock the disconnect method
@@ -195,3 +163,51 @@ async def test_cleanup_session_connections():
         assert sio.disconnect.await_count == 2
         sio.disconnect.assert_any_call('conn1')
         sio.disconnect.assert_any_call('conn2')
+
+
+@pytest.mark.parametrize(
+    'command,exit_code,expected',
+    [
+        ('git checkout feature-branch', 0, True),
+        ('git checkout -b new-feature', 0, True),
+        ('git switch main', 0, True),
+        ('git merge feature-branch', 0, True),
+        ('git rebase main', 0, True),
+        ('git reset --hard HEAD~1', 0, True),
+        ('git branch -m renamed', 0, True),
+        ('cd workspace && git checkout feature-branch', 0, True),
+        ('GIT CHECKOUT feature-branch', 0, True),
+        ('g\u0131t checkout feature-branch', 0, False),
+        ('git \u017fwitch main', 0, False),
+        ('git status', 0, False),
+        ('ls -la', 0, False),
+        ('git checkout missing-branch', 1, False),
+        ('git checkout missing-branch', 128, False),
+    ],
+)
+def test_is_git_related_event(command, exit_code, expected):
+    conversation_manager = StandaloneConversationManager(
+        get_mock_sio(), OpenHandsConfig(), InMemoryFileStore(), MonitoringListener()
+    )
+    event = CmdOutputObservation(
+        content='',
+        command=command,
+        metadata=CmdOutputMetadata(exit_code=exit_code),
+    )
+    assert conversation_manager._is_git_related_event(event) is expected
+
+
+@pytest.mark.parametrize(
+    'current_branch,new_branch,expected',
+    [
+        ('main', 'feature-branch', True),
+        (None, 'feature-branch', True),
+        ('main', 'main', False),
+        ('main', None, False),
+    ],
+)
+def test_should_update_branch(current_branch, new_branch, expected):
+    assert (
+        StandaloneConversationManager._should_update_branch(current_branch, new_branch)
+        is expected
+    )